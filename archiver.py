@@ -10,6 +10,18 @@ import time
 import locale
 import traceback
 import hashlib
+import heapq
+import itertools
+import os
+import cProfile
+import pstats
+import sqlite3
+import json
+import bz2
+import bisect
+import multiprocessing
+import threading
+from xml.etree import ElementTree
 
 from arrow import Arrow
 from datetime import timedelta
@@ -24,10 +36,15 @@ API_URL = "https://en.wikipedia.org/w/api.php"
 LOGIN_INFO = "Lowercase sigmabot III", lcsb3
 SHUTOFF = "User:Lowercase sigmabot III/Shutoff"
 ARCHIVE_TPL = "User:MiszaBot/config"
+PROFILE_PAGES = 0  # Keep profiles of the N slowest pages in a sweep; 0 = off
+PROFILE_DIR = "profiles"
+INDEX_PATH = "archives.sqlite"  # None = don't keep an index of archived threads
 
 locale.setlocale(locale.LC_ALL, "en_US.utf8")
 STAMP_RE = re.compile(r"\d\d:\d\d, \d{1,2} (\w*?) \d\d\d\d \(UTC\)")
+STAMP_FMT = '%H:%M, %d %B %Y (%Z)'
 THE_FUTURE = Arrow.utcnow() + timedelta(365)
+NOWHERE = ("/dev/null", "None", "Nowhere", "none", "nowhere")
 MONTHS = (None, "January", "February", "March", "April", "May", "June",
           "July", "August", "September", "October", "November", "December"
 )
@@ -166,6 +183,268 @@ def str2size(s: str):
     return int(s) * allowed_units[unit], "T" if unit == 't' else "B"
 
 
+class Wiki:
+    """
+    Everything that differs from one wiki to the next: where the API is,
+    who to log in as (nobody, unless told), which template and shutoff page to use, and what the
+    signatures look like. stamp_re must capture the month name, either as
+    a group named "month" or as the first group, and months is the local
+    month table (index 1 is January). Month names are matched regardless
+    of case, and translated to English before they are handed to strptime(),
+    so stamp_fmt should use %B as if the wiki were English. months_short
+    is used for %(monthnameshort)s and defaults to the first three letters
+    of each month, as long as those are all different.
+    Wikis that don't sign in UTC capture the time zone in a group named
+    "tz", and list its abbreviations in timezones, as hours ahead of UTC
+    (e.g. {"CET": 1, "CEST": 2}). The abbreviation is swapped for "UTC"
+    before strptime(), so stamp_fmt reads it with %Z, and the offset is
+    taken off afterwards.
+    """
+    def __init__(self, name, api_url=API_URL, login=None, shutoff=SHUTOFF,
+                 template=ARCHIVE_TPL, stamp_re=STAMP_RE, stamp_fmt=STAMP_FMT,
+                 months=MONTHS, months_short=None, timezones=None, throttle=0.5,
+                 page_delay=0, pages=None):
+        self.name = name
+        self.api_url = api_url
+        self.login = tuple(login) if login else None
+        self.shutoff = shutoff
+        self.template = template
+        if isinstance(stamp_re, str):
+            stamp_re = re.compile(stamp_re)
+        if "month" not in stamp_re.groupindex:
+            if stamp_re.groups < 1 or stamp_re.groupindex.get("tz") == 1:
+                raise ValueError("stamp_re must capture the month name: " + repr(name))
+        if ("tz" in stamp_re.groupindex) != bool(timezones):
+            raise ValueError("stamp_re needs a tz group if and only if timezones "
+                             "are given: " + repr(name))
+        self.timezones = dict(timezones or {})
+        self.stamp_re = stamp_re
+        self.stamp_fmt = stamp_fmt
+
+        def month_table(months):
+            months = tuple(months)
+            if len(months) == 12:
+                months = (None,) + months
+            if len(months) != 13:
+                raise ValueError("A month table needs 12 months: " + repr(name))
+            if len({m.casefold() for m in months[1:]}) != 12:
+                raise ValueError("Month names must all be different: " + repr(name))
+            return months
+        self.months = month_table(months)
+        if months_short is None:
+            try:
+                months_short = month_table(m[:3] for m in self.months[1:])
+            except ValueError:
+                raise ValueError("Short month names would clash, set months_short: " + repr(name))
+        self.months_short = month_table(months_short)
+        self._month_numbers = {m.casefold(): n for n, m in enumerate(self.months) if m}
+        self.throttle = throttle
+        self.page_delay = page_delay  # Seconds to wait between two pages
+        self.pages = pages  # Archive these instead of every transclusion
+
+    @classmethod
+    def from_config(cls, conf: dict):
+        """Build a Wiki from one entry of the --wikis config file"""
+        keys = {"name": "name", "api": "api_url", "login": "login",
+                "shutoff": "shutoff", "template": "template",
+                "stamp_re": "stamp_re", "stamp_fmt": "stamp_fmt",
+                "months": "months", "months_short": "months_short",
+                "timezones": "timezones", "throttle": "throttle",
+                "page_delay": "page_delay", "pages": "pages",
+        }
+        unknown = conf.keys() - keys.keys()
+        if unknown:
+            raise ValueError("Unknown wiki options: " + ", ".join(sorted(unknown)))
+        return cls(**{keys[k]: v for k, v in conf.items()})
+
+    def connect(self):
+        api = MediaWiki(self.api_url, config={"retries": 9, "sleep": 9, "maxlag": 9,
+                                              "throttle": self.throttle})
+        if self.login:
+            api.login(*self.login)
+            #api.login("throwaway", "aoeui")
+        api.set_token("edit")
+        return api
+
+    def parse_stamp(self, match, fmt=None):
+        """Turn a match of self.stamp_re into an Arrow. Raises ValueError
+        if the stamp is not a real date."""
+        replace = {}  # group -> what it should say instead
+        if self.months != MONTHS:
+            group = "month" if "month" in match.re.groupindex else 1
+            try:
+                replace[group] = MONTHS[self._month_numbers[match.group(group).casefold()]]
+            except KeyError:
+                raise ValueError("Unknown month: " + repr(match.group(group)))
+        offset = 0
+        if self.timezones:
+            try:
+                offset = self.timezones[match.group("tz")]
+            except KeyError:
+                raise ValueError("Unknown time zone: " + repr(match.group("tz")))
+            replace["tz"] = "UTC"
+        text = match.group(0)
+        # Work from the end, so the earlier offsets stay right
+        for group in sorted(replace, key=match.start, reverse=True):
+            start = match.start(group) - match.start()
+            end = match.end(group) - match.start()
+            text = text[:start] + replace[group] + text[end:]
+        return Arrow.strptime(text, fmt or self.stamp_fmt) - timedelta(hours=offset)
+
+
+ENWIKI = Wiki("enwiki", login=LOGIN_INFO)
+
+
+def load_wikis(path):
+    """
+    Read a JSON config file listing the wikis to archive, e.g.
+    [{"name": "frwiki", "api": "https://fr.wikipedia.org/w/api.php",
+      "login": ["Username", "password"], "shutoff": "User:Username/Shutoff",
+      "template": "Modèle:Archivage par bot",
+      "stamp_re": "\\d{1,2} (?P<month>\\w+) \\d{4} à \\d\\d:\\d\\d \\((?P<tz>CES?T)\\)",
+      "stamp_fmt": "%d %B %Y à %H:%M (%Z)",
+      "timezones": {"CET": 1, "CEST": 2},
+      "months": ["janvier", "février", ...],
+      "months_short": ["janv.", "févr.", ...]}]
+    Options that are left out take the enwiki defaults, except "login":
+    without it, or with "login": null, the bot does not log in at all, so
+    the enwiki password is never sent anywhere it wasn't asked to go.
+    """
+    with open(path, encoding="utf8") as fh:
+        return [Wiki.from_config(conf) for conf in json.load(fh)]
+
+
+def grouper(iterable, n, fillvalue=None):
+    """Collect data into fixed-length chunks or blocks"""
+    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
+    # Stolen from http://docs.python.org/3.3/library/itertools.html
+    args = [iter(iterable)] * n
+    return itertools.zip_longest(*args, fillvalue=fillvalue)
+
+
+class PageProfiler:
+    """
+    Runs each Archiver under cProfile and keeps the profiles of the
+    slowest pages in a bounded min-heap, so the fastest of the kept
+    pages is the first to be evicted.
+    """
+    def __init__(self, keep: int, directory=PROFILE_DIR):
+        self.keep = keep
+        self.directory = directory
+        self.heap = []
+        self._tiebreak = itertools.count()
+        self._lock = threading.Lock()  # interleave() runs sweeps in threads
+
+    def run(self, bot):
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profile.runcall(bot.run)
+        finally:
+            self.record(bot, time.perf_counter() - start, profile)
+
+    def record(self, bot, elapsed, profile):
+        with self._lock:
+            if len(self.heap) >= self.keep and elapsed <= self.heap[0][0]:
+                return  # Not slow enough to be interesting
+            # Don't touch bot.page.content here, it could set off another API call
+            size = len(bot.page.talkhead) + sum(len(t['header', 'content']) for t in bot.page.threads)
+            entry = (elapsed, next(self._tiebreak), bot.wiki.name, bot.page.title,
+                     size, len(bot.page.threads), profile)
+            if len(self.heap) < self.keep:
+                heapq.heappush(self.heap, entry)
+            else:
+                heapq.heapreplace(self.heap, entry)
+
+    def slowest(self):
+        return sorted(self.heap, reverse=True)
+
+    def dump(self):
+        """Write one .pstats file per page, slowest first, plus an index.
+        The files can be read with pstats, snakeviz, or flameprof. Profiles
+        left over from an earlier run are removed first."""
+        if not self.heap:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for fname in os.listdir(self.directory):
+            if re.match(r"\d{3}-.*\.pstats$", fname):
+                os.remove(os.path.join(self.directory, fname))
+        index = os.path.join(self.directory, "slowest.txt")
+        with open(index, "w") as fh:
+            for rank, entry in enumerate(self.slowest(), 1):
+                elapsed, _, wiki, title, size, thread_count, profile = entry
+                # Titles can be up to 255 bytes, which is too long for a file
+                # name once the rank is added, so the full title only goes in
+                # the index
+                slug = re.sub(r"[^\w.-]+", "_", wiki + "-" + title)[:40]
+                digest = hashlib.md5((wiki + "\n" + title).encode("utf8")).hexdigest()[:8]
+                fname = "{0:03d}-{1}-{2}.pstats".format(rank, slug, digest)
+                pstats.Stats(profile).dump_stats(os.path.join(self.directory, fname))
+                builtins.print("{0:.3f}s".format(elapsed), size, thread_count,
+                               fname, wiki, repr(title), sep="\t", file=fh)
+
+
+IndexEntry = collections.namedtuple("IndexEntry", "wiki fingerprint source archive header stamp revid")
+
+
+class ArchiveIndex:
+    """
+    Remembers where every archived thread went, so that nobody has to dig
+    through the archives to find it, and so that a thread that made it into
+    an archive before the bot fell over is not archived twice.
+    Threads are identified by a hash of their text.
+    """
+    def __init__(self, path=INDEX_PATH, wiki=None):
+        self.wiki = wiki
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS threads (
+                           wiki TEXT, fingerprint TEXT, source TEXT,
+                           archive TEXT, header TEXT, stamp TEXT, revid INTEGER,
+                           PRIMARY KEY (wiki, source, fingerprint))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS by_archive ON threads (wiki, archive)")
+        self.db.commit()
+
+    @staticmethod
+    def fingerprint(text: str):
+        return hashlib.sha1(text.strip().encode("utf8")).hexdigest()
+
+    def add(self, source, archive, threads, revid=None):
+        """Record that threads (as in DiscussionPage.threads) were saved to archive"""
+        rows = [(self.wiki, self.fingerprint(thread['header', 'content']), source,
+                 archive, thread['header'].strip(), thread['stamp'].isoformat(), revid)
+                for thread in threads]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO threads VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def archived(self, source, fingerprint):
+        """Return the archive a thread from source went to, or None.
+        Only saves that came back with a revision id count."""
+        row = self.db.execute("SELECT archive FROM threads WHERE wiki IS ? AND source = ?"
+                              " AND fingerprint = ? AND revid IS NOT NULL",
+                              (self.wiki, source, fingerprint)).fetchone()
+        return row[0] if row else None
+
+    def search(self, term):
+        """Threads whose source or archive page is term, or whose header
+        contains it. Not limited to one wiki if self.wiki is None."""
+        query = ("SELECT * FROM threads WHERE (source = ? OR archive = ? OR header LIKE ? ESCAPE '\\')"
+                 " AND (? IS NULL OR wiki = ?) ORDER BY source, stamp")
+        like = "%" + re.sub(r"([\\%_])", r"\\\1", term) + "%"
+        rows = self.db.execute(query, (term, term, like, self.wiki, self.wiki))
+        return [IndexEntry(*row) for row in rows]
+
+    def close(self):
+        self.db.close()
+
+
+def _revid(result):
+    """Dig the new revision id out of an edit result, if there is one"""
+    if isinstance(result, dict):
+        result = result.get('edit', result)
+        return result.get('newrevid')
+    return None
+
+
 class DiscussionPage(Page):
     def __init__(self, api: MediaWiki, title: str, archiver):
         super().__init__(api, title)
@@ -207,7 +486,9 @@ class DiscussionPage(Page):
             self.sections.append(section)
         self.parse_stamps()  # Modify this if the wiki has a weird stamp format
 
-    def parse_stamps(self, expr=STAMP_RE, fmt='%H:%M, %d %B %Y (%Z)'):
+    def parse_stamps(self, expr=None, fmt=None):
+        wiki = self.archiver.wiki
+        expr = expr or wiki.stamp_re
         stamps = []
         algo = self.archiver.config['algo']
         try:
@@ -225,7 +506,7 @@ class DiscussionPage(Page):
                 # got time fo' dat
                 #if stamp.group(1) in MONTHS:
                 try:
-                    stamps.append(Arrow.strptime(stamp.group(0), fmt))
+                    stamps.append(wiki.parse_stamp(stamp, fmt))
                 except ValueError:  # Invalid stamps should not be parsed, ever
                     continue
             if stamps:
@@ -258,10 +539,14 @@ class DiscussionPage(Page):
         self.talkhead = str(talkhead)
         del new_tpl, talkhead
 
+    def build_text(self):
+        """The talk page as it will look once the archived threads are gone"""
+        self.rebuild_talkhead()
+        return str(self.talkhead) + "".join(map(str, self.sections))
+
     def update(self, archives_touched=None):
         """Remove threads from the talk page after they have been archived"""
-        self.rebuild_talkhead()
-        text = str(self.talkhead) + "".join(map(str, self.sections))
+        text = self.build_text()
         # Instead of counting the sections in the archives, we can count the
         # sections we removed from the page
         arch_thread_count = len([sect for sect in self.sections if not sect])
@@ -311,7 +596,9 @@ class DiscussionPage(Page):
 
 
 class Archiver:
-    def __init__(self, api: MediaWiki, title: str, tl="User:MiszaBot/config"):
+    page_class = DiscussionPage
+
+    def __init__(self, api: MediaWiki, title: str, tl=None, wiki=None, index=None):
         self.config = {'algo': 'old(24h)',
                        'archive': '',
                        'archiveheader': "{{Talk archive}}",
@@ -323,10 +610,14 @@ class Archiver:
                        'key': '',
         }
         self.api = api
-        self.tl = tl
+        self.wiki = wiki or ENWIKI
+        self.index = index  # An ArchiveIndex, or None to archive blindly
+        self.already_archived = {}  # Index of thread -> archive it is already in
+        self.tl = tl or self.wiki.template
         self.archives_touched = frozenset()
         self.indexes_in_archives = collections.defaultdict(list)
-        self.page = DiscussionPage(api, title, self)
+        self.archives_to_touch = {}
+        self.page = self.page_class(api, title, self)
 
     def generate_config(self):
         """Extracts options from the archive template."""
@@ -377,8 +668,8 @@ class Archiver:
             return {'counter': self.config['counter'],
                     'year': stamp.year,
                     'month': stamp.month,
-                    'monthname': MONTHS[stamp.month],
-                    'monthnameshort': MONTHS[stamp.month][:3],
+                    'monthname': self.wiki.months[stamp.month],
+                    'monthnameshort': self.wiki.months_short[stamp.month],
                     'week': stamp.week,
             }
         keep_threads = self.config['minthreadsleft']
@@ -391,8 +682,9 @@ class Archiver:
         # Values should be the text to append, text should be matched to
         # corresponding key based on where the thread belongs
         # Then iterate over .items() and edit the pages
-        p = self.api.page("Coal ball")
+        p = self.archive_page("Coal ball")
         arch_pages = {p.title: p}  # Caching page titles to avoid API spam
+        arch_texts = {}  # And their text, to check the ArchiveIndex against
         arch_thread_count, arch_size, text = 0, 0, ''  # This shuts up PyCharm
         # Archive the oldest threads first, not the highest threads
         # that happen to be old
@@ -407,20 +699,35 @@ class Archiver:
             if not thread["oldenough"]:
                 continue  # Thread is too young to archive
             stamp = thread['stamp']
-            print(thread['header'], "is old enough with stamp", stamp)
             params = make_params()
             subpage = fmt_str % params
+            print(thread['header'], "is old enough with stamp", stamp)
             if not subpage in arch_pages:
-                p = self.api.page(subpage)
+                p = self.archive_page(subpage)
                 arch_pages[subpage] = p
                 try:
                     text = mwp_parse(p.content)
                 except exc.NonexistentPageError:
                     text = mwp_parse("")
+                arch_texts[subpage] = str(text)
                 arch_thread_count = len(text.get_sections(levels=[2]))
                 arch_size = len(text)
             else:
                 p = arch_pages[subpage]
+            if self.index:
+                fingerprint = self.index.fingerprint(thread['header', 'content'])
+                known = self.index.archived(self.page.title, fingerprint)
+                # Only trust the index if the thread would go to the same
+                # archive again, and that archive (which we had to load for
+                # its size anyway) still has it. Archive edits get reverted,
+                # and threads get moved back to the talk page by hand.
+                if known == subpage and thread['header', 'content'].strip() in arch_texts[subpage]:
+                    # Saved last time, but the talk page was never updated
+                    print(thread['header'], "is already in", known)
+                    self.already_archived[index] = known
+                    arched_so_far += 1
+                    self.page.sections[index] = ""
+                    continue
             if max_arch_size[1] == "T":
                 # Size is measured in threads
                 if arch_thread_count + 1 > max_arch_size[0]:
@@ -463,6 +770,7 @@ class Archiver:
             # Remove this thread from the talk page
             self.page.sections[index] = ""
         self.archives_touched = frozenset(archives_to_touch)
+        self.archives_to_touch = archives_to_touch
         archives_actually_touched = []
         if arched_so_far < self.config['minthreadstoarchive']:
             # We might not want to archive a measly few threads
@@ -478,12 +786,14 @@ class Archiver:
             arch_thread_count = len(mwp_parse(content).get_sections(levels=[2]))
             summ = "Archiving {0} discussion(s) from [[{1}]]) (bot"
             summ = summ.format(arch_thread_count, self.page.title)
+            result = None
             try:
                 if page.exists:
-                    print(page.append("\n\n" + content, summ, minor=True, bot=True))
+                    result = page.append("\n\n" + content, summ, minor=True, bot=True)
                 else:
                     content = self.config['archiveheader'] + "\n\n" + content
-                    print(page.create(content, summ, minor=True, bot=True))
+                    result = page.create(content, summ, minor=True, bot=True)
+                print(result)
             except exc.SpamFilterError as e:
                 if e.code == 'spamblacklist':
                     # This is probably going to get fixed someday, but, it
@@ -496,9 +806,10 @@ class Archiver:
                     content = str(code)
                     del code
                     if page.exists:
-                        print(page.append("\n\n" + content, summ, minor=True, bot=True))
+                        result = page.append("\n\n" + content, summ, minor=True, bot=True)
                     else:
-                        print(page.create(content, summ, minor=True, bot=True))
+                        result = page.create(content, summ, minor=True, bot=True)
+                    print(result)
             except Exception as e:
                 if "JSON" in str(e):
                     traceback.print_exc()
@@ -507,6 +818,13 @@ class Archiver:
                     raise
             print("Actually archived", repr(title))
             archives_actually_touched.append(title)
+            revid = _revid(result)
+            if self.index and revid:
+                threads = [self.page.threads[i] for i in self.indexes_in_archives[title]]
+                self.index.add(self.page.title, title, threads, revid)
+            elif self.index:
+                # The save may not have happened, so it can't be used to skip threads
+                print("No revision id, not indexing", repr(title))
             # If the bot explodes mid-loop, we know which archive pages
             # were actually saved
             self.archives_touched = frozenset(archives_actually_touched)
@@ -539,27 +857,333 @@ class Archiver:
             self.config['counter'] -= total_counter_increments
         self.page.update()
 
+    def archive_page(self, title):
+        return self.api.page(title)
+
     def key_ok(self):
-        return self.config['key'] == make_key(self.page.title)
+        # No key can never be the right key, so don't bother with the salt
+        return bool(self.config['key']) and self.config['key'] == make_key(self.page.title)
 
-    def run(self):
+    def prepare(self):
+        """
+        Parse the page and decide where every thread goes, without editing
+        anything. Returns the archive_threads() generator, paused just before
+        it saves the archives, or None if there is nothing to archive.
+        """
         self.generate_config()  # If it fails, abandon page
         self.page.generate_threads()
         self.page.rebuild_talkhead(dry=True)  # Raises an exception if it fails
-        if self.config['archive'] not in ("/dev/null", "None", "Nowhere", "none", "nowhere"):  # Don't post to an archive if these keywords are used
-            if not self.config['archive'].startswith(self.page.title + "/"):
-                if not self.key_ok():
-                    raise ArchiveSecurityError("Bad key: " + repr(self.config['key']))
-            time_machine = self.archive_threads()
+        if self.config['archive'] in NOWHERE:  # Don't post to an archive if these keywords are used
+            return None
+        if not self.config['archive'].startswith(self.page.title + "/"):
+            if not self.key_ok():
+                raise ArchiveSecurityError("Bad key: " + repr(self.config['key']))
+        time_machine = self.archive_threads()
+        try:
+            next(time_machine)  # Prepare the archive pages
+        except StopIteration:  # Don't archive a measly few threads
+            return None
+        return time_machine
+
+    def run(self):
+        time_machine = self.prepare()
+        if time_machine is None:
+            return
+        # Now let's pause execution for a bit
+        touched = self.archives_touched | frozenset(self.already_archived.values())
+        self.page.update(touched)  # Assume that we won't fail
+        # Save the archives last (so that we don't fuck up if we can't edit the TP)
+        # Bugs won't cause a loss of data thanks to unarchive_threads()
+        next(time_machine)  # Continue archiving
+
+
+class SnapshotPage(DiscussionPage):
+    """
+    A page whose text comes from a local dump instead of the API. Missing
+    pages behave like pages that don't exist yet, and any attempt to edit
+    blows up, so a Planner can never touch the wiki.
+    """
+    def __init__(self, api, title: str, archiver):
+        # Page.__init__() is skipped on purpose, there is no API to talk to
+        self._snapshot_title = title
+        self.archiver = archiver
+        self.reset()
+
+    @property
+    def title(self):
+        return self._snapshot_title
+
+    @property
+    def exists(self):
+        return self.title in self.archiver.snapshot
+
+    @property
+    def content(self):
+        return self.archiver.snapshot.get(self.title, "")
+
+    def edit(self, *args, **kw):
+        raise ArchiveError("Plan-only mode never edits")
+
+    append = create = edit
+
+
+class Planner(Archiver):
+    """Work out what the bot would do to a page in a snapshot, at full speed"""
+    page_class = SnapshotPage
+
+    def __init__(self, title: str, snapshot, tl=None, wiki=None, index=None):
+        self.snapshot = snapshot  # title -> wikitext
+        self.warnings = []
+        super().__init__(None, title, tl, wiki, index)
+
+    def archive_page(self, title):
+        return SnapshotPage(None, title, self)
+
+    def key_ok(self):
+        try:
+            return super().key_ok()
+        except FileNotFoundError:
+            # The salt only lives on the bot's own machine
+            self.warnings.append("key not checked: no salt file")
+            return True
+
+    def plan(self):
+        """Return a JSON-friendly dict describing the threads that would
+        move, where they would go, and how the pages would change."""
+        if not self.page.exists:
+            raise ArchiveError("Not in snapshot")
+        time_machine = self.prepare()
+        plan = {"title": self.page.title, "moved": [], "archives": {},
+                "counter": [self.config['oldcounter'], self.config['counter']],
+                "talk_bytes": 0, "warnings": self.warnings,
+        }
+        if time_machine is None:
+            # Placement may have bumped the counter, but nothing gets saved
+            plan['counter'] = [self.config['oldcounter']] * 2
+            return plan
+        for subpage, indexes in self.indexes_in_archives.items():
+            for index in indexes:
+                thread = self.page.threads[index]
+                plan['moved'].append({"header": thread['header'].strip(),
+                                      "stamp": thread['stamp'].isoformat(),
+                                      "archive": subpage,
+                                      "bytes": len(thread['header', 'content'].encode("utf8")),
+                })
+        for index, subpage in self.already_archived.items():
+            plan['moved'].append({"header": self.page.threads[index]['header'].strip(),
+                                  "stamp": self.page.threads[index]['stamp'].isoformat(),
+                                  "archive": subpage,
+                                  "bytes": 0,  # Already there, so only removed
+            })
+        for subpage, content in self.archives_to_touch.items():
+            page = self.archive_page(subpage)
+            if page.exists:
+                added = "\n\n" + content
+            else:
+                added = self.config['archiveheader'] + "\n\n" + content
+            plan['archives'][subpage] = {"bytes": len(added.encode("utf8")),
+                                         "threads": len(self.indexes_in_archives[subpage]),
+                                         "new": not page.exists,
+            }
+        old_text = self.page.content
+        plan['talk_bytes'] = len(self.page.build_text().encode("utf8")) - len(old_text.encode("utf8"))
+        return plan
+
+
+def read_dump(path):
+    """Yield (title, text) for every page in a MediaWiki XML dump or
+    Special:Export file, optionally bzip2'd. Pages without any text are
+    left out."""
+    opener = bz2.open if path.endswith(".bz2") else open
+    with opener(path, "rb") as fh:
+        root = None
+        title = text = None
+        for event, elem in ElementTree.iterparse(fh, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event == "start":
+                continue
+            tag = elem.tag.rpartition("}")[2]  # Dumps are namespaced
+            if tag == "title":
+                title = elem.text
+            elif tag == "text":
+                text = elem.text or ""  # The last revision wins
+            elif tag == "page":
+                if title is not None and text is not None:
+                    yield title, text
+                title = text = None
+                root.clear()  # Otherwise every page stays attached to the root
+
+
+def archive_prefix(title, text, wiki=ENWIKI):
+    """The part of the archive= parameter that comes before the first
+    %(...)s, read by generate_config() so it comes from the right template.
+    Falls back to the page's subpages."""
+    planner = Planner(title, {title: text}, wiki=wiki)
+    try:
+        planner.generate_config()
+    except ArchiveError:
+        return title + "/"
+    return planner.config['archive'].split("%(")[0] or title + "/"
+
+
+def load_snapshot(path, wiki=ENWIKI):
+    """
+    Read the pages of a dump that plan_dump() needs: the ones that use the
+    archive template, and the ones that could be their archives. This takes
+    two passes over the dump, so the rest of it never has to sit in memory.
+    Returns (snapshot, titles of the pages that use the template).
+    """
+    # Cheap filter, generate_config() does the real check. It is loose
+    # about case and underscores, so that nothing the bot would archive is
+    # left out of the plan.
+    needle = wiki.template.split(":")[-1].replace("_", " ").lower()
+    snapshot = {}
+    prefixes = set()
+    for title, text in read_dump(path):
+        if needle in text.replace("_", " ").lower():
+            snapshot[title] = text
+            prefixes.add(archive_prefix(title, text, wiki))
+    titles = list(snapshot)
+    # Drop the prefixes that start with another prefix, so that the only
+    # prefix a title can start with is the greatest one that sorts before it
+    kept = []
+    for prefix in sorted(prefixes):
+        if not (kept and prefix.startswith(kept[-1])):
+            kept.append(prefix)
+    prefixes = kept
+    for title, text in read_dump(path):
+        n = bisect.bisect_right(prefixes, title)
+        if n and title.startswith(prefixes[n - 1]):
+            snapshot.setdefault(title, text)
+    return snapshot, titles
+
+
+_snapshot = {}
+
+
+def _quiet():
+    # Plan workers would otherwise spend their time appending to archivebot.log
+    globals()['print'] = lambda *args, **kw: None
+
+
+def _plan_one(args):
+    title, wiki = args
+    try:
+        return Planner(title, _snapshot, wiki=wiki).plan()
+    except Exception as e:
+        return {"title": title, "error": "{0}: {1}".format(type(e).__name__, e)}
+
+
+def plan_dump(path, wiki=ENWIKI, processes=None):
+    """
+    Yield a plan for every page in the dump that uses the archive template.
+    The dump is loaded once and shared with the worker processes by fork(),
+    because archive pages are needed to decide when the counter goes up.
+    """
+    global _snapshot
+    _snapshot, titles = load_snapshot(path, wiki)
+    with multiprocessing.get_context("fork").Pool(processes, _quiet) as pool:
+        yield from pool.imap(_plan_one, ((title, wiki) for title in titles), chunksize=64)
+
+
+def sweep(wiki: Wiki, victims=None, profiler=None, archiver=Archiver,
+          index_path=INDEX_PATH):
+    """
+    Archive every page on one wiki. This is a generator: it yields the
+    number of seconds it would like to wait before carrying on.
+    Set index_path to None to archive without an ArchiveIndex.
+    """
+    index = ArchiveIndex(index_path, wiki.name) if index_path else None
+    try:
+        yield from _sweep(wiki, victims, profiler, archiver, index)
+    finally:
+        if index:
+            index.close()
+
+
+def _sweep(wiki, victims, profiler, archiver, index):
+    api = wiki.connect()
+    shutoff_page = api.page(wiki.shutoff)
+    if victims is None:
+        victims = itertools.chain((x['title'] for x in api.iterator(list='embeddedin',
+                                                                    eititle=wiki.template,
+                                                                    #einamespace=[3,4],
+                                                                    #eititle="Template:Experimental archiving",
+                                                                    eilimit=500)),
+                                  # wp("Administrators' noticeboard/Edit warring",
+                                  #    "Requests for undeletion",
+                                  # ),
+                                  # t("RuneScape",
+                                  #   "Main Page",
+                                  # ),
+                                  # wt("Did you know",
+                                  #    "Twinkle",
+                                  # ),
+        )
+    for subvictims in grouper(victims, 25, None):
+        subvictims = RedoableIterator(subvictims)
+        # To not spam the API, only check the shutoff page every 25 archives.
+        try:
+            shutoff_page.load_attributes()
+        except exc.ApiError:
+            # We'll survive another 25 pages
+            pass
+        if shutoff_page.content.lower() != "true":
+            print("Check the shutoff page on", wiki.name)
+            break
+        api.set_token("edit")
+        for victim in subvictims:
+            if victim is None:
+                # TODO: Convert this part into iter(func, sentinel=None)
+                break
+            bot = archiver(api, victim, wiki=wiki, index=index)
             try:
-                next(time_machine)  # Prepare the archive pages
-            except StopIteration:  # Don't archive a measly few threads
-                return
-            # Now let's pause execution for a bit
-            self.page.update(self.archives_touched)  # Assume that we won't fail
-            # Save the archives last (so that we don't fuck up if we can't edit the TP)
-            # Bugs won't cause a loss of data thanks to unarchive_threads()
-            next(time_machine)  # Continue archiving
+                print("Working on", repr(victim), "on", wiki.name)
+                if profiler:
+                    profiler.run(bot)
+                else:
+                    bot.run()
+            except Exception as e:
+                traceback.print_exc()
+                warn(bot.page)
+                if isinstance(e, ArchiveError):
+                    continue
+                elif isinstance(e, exc.ApiError):
+                    yield 5  # Let the API calm down
+                    subvictims.redo()
+                    continue
+                try:
+                    bot.unarchive_threads()
+                except:
+                    warn(bot.page)
+                    continue
+            else:
+                print("Successfully worked on", repr(victim))
+            yield wiki.page_delay
+
+
+def interleave(sweeps):
+    """
+    Run several sweep() generators from one process, each in its own
+    worker thread. ceterach's per-request throttle, the back-off after an
+    API error and page_delay all sleep in the worker of the wiki that asked
+    for them, so while one wiki waits, the others get on with their work.
+    A wiki that blows up is dropped without stopping the rest.
+    """
+    def work(s):
+        try:
+            for wait in s:
+                if wait:
+                    time.sleep(wait)
+        except Exception:
+            traceback.print_exc()
+    workers = [threading.Thread(target=work, args=(s,), daemon=True) for s in sweeps]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)  # A bare join() can't be interrupted by ^C
 
 
 import unittest
@@ -661,17 +1285,293 @@ class TestShit(unittest.TestCase):
         s = "34j"
         self.assertRaises(ValueError, lambda: str2time(s).total_seconds())
 
+
+    def test_page_profiler(self):
+        class FakePage:
+            talkhead = "xxx"
+            threads = [{("header", "content"): "abcde"}] * 2
+            def __init__(self, title):
+                self.title = title
+        class FakeBot:
+            def __init__(self, title):
+                self.page = FakePage(title)
+                self.wiki = ENWIKI
+        profiler = PageProfiler(2)
+        for elapsed, title in [(3, "A"), (1, "B"), (5, "C"), (2, "D")]:
+            profiler.record(FakeBot(title), elapsed, None)
+        slowest = [(e[0], e[2], e[3], e[4], e[5]) for e in profiler.slowest()]
+        self.assertEqual([(5, "enwiki", "C", 13, 2), (3, "enwiki", "A", 13, 2)], slowest)
+
+    def test_page_profiler_long_titles(self):
+        import tempfile
+        class FakePage:
+            talkhead = ""
+            threads = []
+            title = "User talk:" + "é" * 120
+        class FakeBot:
+            page = FakePage()
+            wiki = ENWIKI
+            def run(self):
+                pass
+        with tempfile.TemporaryDirectory() as directory:
+            # Left over from a longer run
+            open(os.path.join(directory, "002-enwiki-Talk_Old-0123abcd.pstats"), "w").close()
+            profiler = PageProfiler(1, directory)
+            profiler.run(FakeBot())
+            profiler.dump()
+            with open(os.path.join(directory, "slowest.txt")) as fh:
+                self.assertIn(repr(FakePage.title), fh.read())
+            self.assertEqual(2, len(os.listdir(directory)))
+
+    def test_wiki_month_table(self):
+        months = ["janvier", "février", "mars", "avril", "mai", "juin", "juillet",
+                  "août", "septembre", "octobre", "novembre", "décembre"]
+        short = ["janv.", "févr.", "mars", "avr.", "mai", "juin", "juil.",
+                 "août", "sept.", "oct.", "nov.", "déc."]
+        frwiki = Wiki("frwiki", months=months, months_short=short)
+        stamp = frwiki.stamp_re.search("Bonjour 13:37, 9 février 2013 (UTC)")
+        parsed = frwiki.parse_stamp(stamp)
+        self.assertEqual((2013, 2, 9, 13, 37), (parsed.year, parsed.month,
+                                                parsed.day, parsed.hour,
+                                                parsed.minute))
+        stamp = frwiki.stamp_re.search("13:37, 9 Février 2013 (UTC)")
+        self.assertEqual(2, frwiki.parse_stamp(stamp).month)
+        stamp = frwiki.stamp_re.search("13:37, 9 February 2013 (UTC)")
+        self.assertRaises(ValueError, lambda: frwiki.parse_stamp(stamp))
+        self.assertEqual(("juin", "juil."), frwiki.months_short[6:8])
+        self.assertEqual("Jun", ENWIKI.months_short[6])
+        # A real frwiki signature, in winter and in summer
+        frwiki = Wiki("frwiki", months=months, months_short=short,
+                      stamp_re=r"\d{1,2} (?P<month>\w+) \d{4} à \d\d:\d\d \((?P<tz>CES?T)\)",
+                      stamp_fmt="%d %B %Y à %H:%M (%Z)", timezones={"CET": 1, "CEST": 2})
+        stamp = frwiki.stamp_re.search("Salut. Toto (discuter) 9 février 2013 à 13:37 (CET)")
+        parsed = frwiki.parse_stamp(stamp)
+        self.assertEqual((2013, 2, 9, 12, 37), (parsed.year, parsed.month, parsed.day,
+                                                parsed.hour, parsed.minute))
+        stamp = frwiki.stamp_re.search("1 juillet 2013 à 00:15 (CEST)")
+        parsed = frwiki.parse_stamp(stamp)
+        self.assertEqual((2013, 6, 30, 22, 15), (parsed.year, parsed.month, parsed.day,
+                                                 parsed.hour, parsed.minute))
+        self.assertRaises(ValueError, lambda: Wiki("tz", stamp_re=frwiki.stamp_re, months=months,
+                                                   months_short=short))
+        # juin and juillet would both be "jui"
+        self.assertRaises(ValueError, lambda: Wiki("frwiki", months=months))
+        self.assertRaises(ValueError, lambda: Wiki("nogroup", stamp_re=r"\d\d:\d\d"))
+        self.assertRaises(ValueError, lambda: Wiki("short", months=["janvier"]))
+        self.assertRaises(ValueError, lambda: Wiki.from_config({"name": "x", "bogus": 1}))
+        # Only the wikis that ask for a login get one
+        self.assertIsNone(Wiki.from_config({"name": "x", "api": "http://localhost/api.php"}).login)
+        self.assertEqual(LOGIN_INFO, ENWIKI.login)
+
+    def test_sweeps_against_stand_in_apis(self):
+        import tempfile
+        class StandInPage(DiscussionPage):
+            def __init__(self, api, title, archiver=None):
+                self.stand_in = api
+                self._stand_in_title = title
+                self.archiver = archiver
+                self.reset()
+            title = property(lambda self: self._stand_in_title)
+            exists = property(lambda self: self.title in self.stand_in.texts)
+            @property
+            def content(self):
+                self.stand_in.request()
+                return self.stand_in.texts.get(self.title, "")
+            def load_attributes(self):
+                self.stand_in.request()
+            def edit(self, text, summ, **kw):
+                self.stand_in.request()
+                self.stand_in.texts[self.title] = text
+                return {"edit": {"result": "Success", "newrevid": len(self.stand_in.texts)}}
+            create = edit
+            def append(self, text, summ, **kw):
+                return self.edit(self.stand_in.texts[self.title] + text, summ)
+        class StandInApi:
+            """One wiki, which makes every request wait like a throttle would"""
+            def __init__(self, texts, delay):
+                self.texts = texts
+                self.delay = delay
+                self.requests = 0
+            def request(self):
+                self.requests += 1
+                time.sleep(self.delay)
+            def login(self, *args):
+                self.request()
+            set_token = login
+            def page(self, title):
+                return StandInPage(self, title)
+            def iterator(self, eititle, **kw):
+                self.request()
+                return [{"title": t} for t in sorted(self.texts) if eititle in self.texts[t]]
+        class StandInArchiver(Archiver):
+            page_class = StandInPage
+        def talk_page(tl):
+            return ("{{" + tl + "\n|archive=Talk:Foo/Archive %(counter)d\n|minthreadsleft=1\n"
+                    "|minthreadstoarchive=1\n|algo=old(1d)\n}}\n\n"
+                    "== One ==\nHi. 12:00, 1 January 2013 (UTC)\n\n"
+                    "== Two ==\nHi. 12:00, 2 January 2013 (UTC)\n")
+        apis, wikis = [], []
+        for name, tl in [("enwiki", "User:MiszaBot/config"), ("frwiki", "Modèle:Archivage")]:
+            api = StandInApi({"Talk:Foo": talk_page(tl), "Shutoff": "true"}, 0.02)
+            wiki = Wiki(name, shutoff="Shutoff", template=tl)
+            wiki.connect = lambda api=api: api
+            apis.append(api)
+            wikis.append(wiki)
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)  # The bot writes its logs to the working directory
+            try:
+                start = time.monotonic()
+                interleave([sweep(wiki, archiver=StandInArchiver) for wiki in wikis])
+                elapsed = time.monotonic() - start
+                for wiki in wikis:
+                    index = ArchiveIndex(INDEX_PATH, wiki.name)
+                    self.assertEqual(["== One =="], [e.header for e in index.search("Talk:Foo")])
+                    index.close()
+            finally:
+                os.chdir(cwd)
+        for api in apis:
+            self.assertIn("== One ==", api.texts["Talk:Foo/Archive 1"])
+            self.assertNotIn("== One ==", api.texts["Talk:Foo"])
+            self.assertIn("== Two ==", api.texts["Talk:Foo"])
+        # One wiki's throttle waits were spent working on the other
+        one_after_another = sum(api.requests for api in apis) * 0.02
+        self.assertLess(elapsed, one_after_another * 0.8)
+
+    def test_planner(self):
+        snapshot = {"Talk:Foo": "{{User:MiszaBot/config\n|archive=Talk:Foo/Archive %(counter)d\n"
+                                "|maxarchivesize=1T\n|minthreadsleft=1\n|minthreadstoarchive=1\n"
+                                "|algo=old(1d)\n}}\n\n"
+                                "== One ==\nHi. 12:00, 1 January 2013 (UTC)\n\n"
+                                "== Two ==\nHi. 12:00, 2 January 2013 (UTC)\n\n"
+                                "== Three ==\nHi. 12:00, 3 January 2013 (UTC)\n",
+                    "Talk:Foo/Archive 1": "== Full ==\n",
+        }
+        plan = Planner("Talk:Foo", snapshot).plan()
+        self.assertEqual([("== One ==", "Talk:Foo/Archive 2"), ("== Two ==", "Talk:Foo/Archive 3")],
+                         [(m['header'], m['archive']) for m in plan['moved']])
+        self.assertEqual([1, 3], plan['counter'])
+        self.assertTrue(plan['archives']["Talk:Foo/Archive 2"]['new'])
+        self.assertLess(plan['talk_bytes'], 0)
+        # Nothing in the snapshot may change
+        self.assertEqual("== Full ==\n", snapshot["Talk:Foo/Archive 1"])
+        self.assertRaises(ArchiveError, lambda: Planner("Talk:Bar", snapshot).plan())
+        # Archive 1 is full, and one thread is not enough to archive, so the
+        # counter must not go up either
+        snapshot["Talk:Foo"] = snapshot["Talk:Foo"].replace("minthreadstoarchive=1",
+                                                            "minthreadstoarchive=5")
+        plan = Planner("Talk:Foo", snapshot).plan()
+        self.assertEqual(([], {}, [1, 1], 0), (plan['moved'], plan['archives'],
+                                               plan['counter'], plan['talk_bytes']))
+
+    def test_plan_dump(self):
+        import tempfile
+        page = "<page><title>{0}</title><revision>{1}</revision></page>\n"
+        text = "<text>{0}</text>"
+        config = ("{{{{Modèle:Archivage\n|archive={0}\n|maxarchivesize=1T\n{1}"
+                  "|minthreadsleft=1\n|minthreadstoarchive=1\n|algo=old(1d)\n}}}}\n\n"
+                  "== Un ==\nSalut. 12:00, 1 janvier 2013 (UTC)\n\n"
+                  "== Deux ==\nSalut. 12:00, 2 janvier 2013 (UTC)\n")
+        # Another template with an archive= comes first, and the real one
+        # has a comment in it
+        foo = ("{{Autre|archive=Ailleurs/%(counter)d}}\n"
+               + config.format("Discussion:Foo/Archive %(counter)d<!-- ne pas toucher -->", ""))
+        dump = ('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/">\n'
+                + page.format("Discussion:Foo/Archive 1", text.format("== Plein ==\n"))
+                + page.format("Discussion:Foo", text.format(foo))
+                + page.format("Discussion:Bar", "")  # No text, must not inherit Foo's
+                + page.format("Discussion:Autre", text.format("Rien à voir"))
+                + page.format("Archives/Baz 1", text.format("== Vieux ==\n"))
+                + page.format("Discussion:Baz", text.format(config.format("Archives/Baz %(counter)d", "")))
+                + page.format("Discussion:Qux", text.format(config.format("Archives/Qux %(counter)d",
+                                                                          "|key=0123456789abcdef\n")))
+                + "</mediawiki>\n")
+        frwiki = Wiki("frwiki", template="Modèle:Archivage",
+                      months=["janvier", "février", "mars", "avril", "mai", "juin",
+                              "juillet", "août", "septembre", "octobre", "novembre",
+                              "décembre"],
+                      months_short=["janv.", "févr.", "mars", "avr.", "mai", "juin",
+                                    "juil.", "août", "sept.", "oct.", "nov.", "déc."])
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dump.xml")
+            with open(path, "w", encoding="utf8") as fh:
+                fh.write(dump)
+            self.assertNotIn("Discussion:Bar", dict(read_dump(path)))
+            snapshot, titles = load_snapshot(path, frwiki)
+            self.assertEqual(["Discussion:Foo", "Discussion:Baz", "Discussion:Qux"], titles)
+            self.assertEqual({"Discussion:Foo", "Discussion:Foo/Archive 1", "Discussion:Baz",
+                              "Archives/Baz 1", "Discussion:Qux"}, set(snapshot))
+            os.chdir(directory)  # Where there is no salt
+            try:
+                plans = {plan['title']: plan for plan in plan_dump(path, frwiki, processes=2)}
+            finally:
+                os.chdir(cwd)
+        self.assertEqual({"Discussion:Foo", "Discussion:Baz", "Discussion:Qux"}, set(plans))
+        self.assertEqual([("== Un ==", "Discussion:Foo/Archive 2")],
+                         [(m['header'], m['archive']) for m in plans["Discussion:Foo"]['moved']])
+        self.assertEqual([1, 2], plans["Discussion:Foo"]['counter'])
+        # Not a subpage, and no key
+        self.assertTrue(plans["Discussion:Baz"]['error'].startswith("ArchiveSecurityError"))
+        # Not a subpage, and a key that can't be checked without the salt
+        self.assertEqual(["key not checked: no salt file"], plans["Discussion:Qux"]['warnings'])
+        self.assertEqual(["Archives/Qux 1"], list(plans["Discussion:Qux"]['archives']))
+
+    def test_archive_index(self):
+        index = ArchiveIndex(":memory:", "enwiki")
+        thread = {"header": "== 100%_done ==", "content": "\nHi\n",
+                  ("header", "content"): "== 100%_done ==\nHi\n",
+                  "stamp": Arrow(2013, 1, 1)}
+        fingerprint = index.fingerprint("== 100%_done ==\nHi")
+        self.assertIsNone(index.archived("Talk:Foo", fingerprint))
+        index.add("Talk:Foo", "Talk:Foo/Archive 1", [thread], 1234)
+        self.assertEqual("Talk:Foo/Archive 1", index.archived("Talk:Foo", fingerprint))
+        self.assertIsNone(index.archived("Talk:Bar", fingerprint))
+        entries = index.search("Talk:Foo/Archive 1")
+        self.assertEqual([("Talk:Foo", "== 100%_done ==", 1234)],
+                         [(e.source, e.header, e.revid) for e in entries])
+        self.assertEqual(1, len(index.search("0%_d")))
+        self.assertEqual(0, len(index.search("0_")))
+        self.assertEqual([], index.search("Talk:Bar"))
+
+    def test_archive_index_skips_archived_threads(self):
+        one = "== One ==\nHi. 12:00, 1 January 2013 (UTC)\n\n"
+        snapshot = {"Talk:Foo": "{{User:MiszaBot/config\n|archive=Talk:Foo/Archive 1\n"
+                                "|minthreadsleft=1\n|minthreadstoarchive=1\n|algo=old(1d)\n}}\n\n"
+                                + one + "== Two ==\nHi. 12:00, 2 January 2013 (UTC)\n",
+                    "Talk:Foo/Archive 1": "{{Talk archive}}\n\n" + one,
+        }
+        thread = {"header": "== One ==", ("header", "content"): one,
+                  "stamp": Arrow(2013, 1, 1, 12)}
+        def plan_with(archive, revid=1234):
+            index = ArchiveIndex(":memory:", "enwiki")
+            index.add("Talk:Foo", archive, [thread], revid)
+            return Planner("Talk:Foo", snapshot, index=index).plan()
+        def moved(plan):
+            return [(m['header'], m['archive'], m['bytes'] > 0) for m in plan['moved']]
+        # Saved last time, but the talk page edit never happened
+        plan = plan_with("Talk:Foo/Archive 1")
+        self.assertEqual({}, plan['archives'])
+        self.assertEqual([("== One ==", "Talk:Foo/Archive 1", False)], moved(plan))
+        archived_again = [("== One ==", "Talk:Foo/Archive 1", True)]
+        # The index says it went elsewhere, which this run would not pick
+        plan = plan_with("Talk:Foo/Wrong archive")
+        self.assertEqual(["Talk:Foo/Archive 1"], list(plan['archives']))
+        self.assertEqual(archived_again, moved(plan))
+        # The save was never confirmed
+        self.assertEqual(archived_again, moved(plan_with("Talk:Foo/Archive 1", None)))
+        # The thread was taken back out of the archive...
+        snapshot["Talk:Foo/Archive 1"] = "{{Talk archive}}\n"
+        self.assertEqual(archived_again, moved(plan_with("Talk:Foo/Archive 1")))
+        # ...or the archive is gone altogether
+        del snapshot["Talk:Foo/Archive 1"]
+        plan = plan_with("Talk:Foo/Archive 1")
+        self.assertTrue(plan['archives']["Talk:Foo/Archive 1"]['new'])
+        self.assertEqual(archived_again, moved(plan))
+
 if __name__ == "__main__":
 
     #unittest.main(verbosity=2)
-    import itertools
-
-    def grouper(iterable, n, fillvalue=None):
-        """Collect data into fixed-length chunks or blocks"""
-        # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
-        # Stolen from http://docs.python.org/3.3/library/itertools.html
-        args = [iter(iterable)] * n
-        return itertools.zip_longest(*args, fillvalue=fillvalue)
 
     def page_gen_dec(ns):
         def decorator(func):
@@ -687,62 +1587,37 @@ if __name__ == "__main__":
     wp = page_gen_dec("Wikipedia")(generic_func)
     wt = page_gen_dec("Wikipedia talk")(generic_func)
 
-    api = MediaWiki(API_URL, config={"retries": 9, "sleep": 9, "maxlag": 9, "throttle": 0.5})
-    api.login(*LOGIN_INFO)
-    #api.login("throwaway", "aoeui")
-    api.set_token("edit")
-    shutoff_page = api.page(SHUTOFF)
-    victims = itertools.chain((x['title'] for x in api.iterator(list='embeddedin',
-                                                                eititle=ARCHIVE_TPL,
-                                                                #einamespace=[3,4],
-                                                                #eititle="Template:Experimental archiving",
-                                                                eilimit=500)),
-                              # wp("Administrators' noticeboard/Edit warring",
-                              #    "Requests for undeletion",
-                              # ),
-                              # t("RuneScape",
-                              #   "Main Page",
-                              # ),
-                              # wt("Did you know",
-                              #    "Twinkle",
-                              # ),
-    )
-    if len(sys.argv) > 1:
-        victims = sys.argv[1:]
-    for subvictims in grouper(victims, 25, None):
-        subvictims = RedoableIterator(subvictims)
-        # To not spam the API, only check the shutoff page every 25 archives.
-        try:
-            shutoff_page.load_attributes()
-        except exc.ApiError:
-            # We'll survive another 25 pages
-            pass
-        if shutoff_page.content.lower() != "true":
-            print("Check the shutoff page")
-            break
-        api.set_token("edit")
-        for victim in subvictims:
-            if victim is None:
-                # TODO: Convert this part into iter(func, sentinel=None)
-                break
-            bot = Archiver(api, victim)
+    if len(sys.argv) > 2 and sys.argv[1] == "--index":
+        # archiver.py --index "Talk:Foo" [wiki name]
+        if not INDEX_PATH:
+            sys.exit("INDEX_PATH is not set, there is no index to search")
+        index = ArchiveIndex(INDEX_PATH, sys.argv[3] if len(sys.argv) > 3 else None)
+        for entry in index.search(sys.argv[2]):
+            builtins.print(*entry, sep="\t")
+        sys.exit()
+
+    if len(sys.argv) > 2 and sys.argv[1] == "--plan":
+        # archiver.py --plan DUMP [--wikis wikis.json NAME]
+        wiki = ENWIKI
+        if len(sys.argv) > 5 and sys.argv[3] == "--wikis":
+            wikis = {w.name: w for w in load_wikis(sys.argv[4])}
+            if sys.argv[5] not in wikis:
+                sys.exit("No wiki called {0!r} in {1}".format(sys.argv[5], sys.argv[4]))
+            wiki = wikis[sys.argv[5]]
+        for plan in plan_dump(sys.argv[2], wiki):
+            builtins.print(json.dumps(plan, ensure_ascii=False))
+        sys.exit()
+
+    profiler = PageProfiler(PROFILE_PAGES) if PROFILE_PAGES > 0 else None
+    if len(sys.argv) > 2 and sys.argv[1] == "--wikis":
+        sweeps = [sweep(wiki, wiki.pages, profiler) for wiki in load_wikis(sys.argv[2])]
+    else:
+        sweeps = [sweep(ENWIKI, sys.argv[1:] or None, profiler)]
+    try:
+        interleave(sweeps)
+    finally:
+        if profiler:
             try:
-                print("Working on", repr(victim))
-                bot.run()
-            except Exception as e:
-                crap = e
-                traceback.print_exc()
-                warn(bot.page)
-                if isinstance(e, ArchiveError):
-                    continue
-                elif isinstance(e, exc.ApiError):
-                    time.sleep(5)
-                    subvictims.redo()
-                    continue
-                try:
-                    bot.unarchive_threads()
-                except:
-                    warn(bot.page)
-                    continue
-            else:
-                print("Successfully worked on", repr(victim))
\ No newline at end of file
+                profiler.dump()
+            except Exception:
+                traceback.print_exc()  # Don't hide whatever stopped the sweep